@@ -73,7 +73,8 @@ class DocBuilder:
         print('WRITING DOCUMENTATION FILES')
         writers.StaticFileCopier().run()
         try:
-            writers.IPythonNotebookReSTWriter().run()
+            writers.IPythonNotebookReSTWriter(
+                useMultiprocessing=self.useMultiprocessing).run()
         except OSError:
             raise ImportError('IPythonNotebookReSTWriter crashed; most likely cause: ' +
                               'no pandoc installed: https://github.com/jgm/pandoc/releases')
@@ -11,22 +11,56 @@
 # License:      BSD, see license.txt
 # ------------------------------------------------------------------------------
 
+import contextlib
+import hashlib
+import io
+import json
 import os
 import pathlib
 import re
 import shutil
+import tempfile
+import time
+import unittest
 
 from music21 import common
 from music21 import exceptions21
 
-from more_itertools import windowed
-
 from music21 import environment
 environLocal = environment.Environment('docbuild.writers')
 
 from . import documenters
 from . import iterators
 
+# Everything that IPythonNotebookReSTWriter.cleanConvertedNotebook changes, in one
+# pattern:
+#   prompt -- an IPython prompt, and the blank line that follows it
+#   ignore -- a line marked "# ignore this" and the line after it (usually
+#       %load_ext ...), along with the '.. code:: ' line and blank line before it.
+#       The '.. code:: ' line goes only if it is exactly two lines above in the
+#       converted text and the line between is neither a prompt nor another
+#       "# ignore this" line (those are matched and removed on their own).
+#   image -- an image directive, whose path might need correcting
+#   reference -- :class:``x`` and the like, as mangled by markdown
+_notebookCleanupPattern = re.compile(
+    r'(?P<prompt>^In\[[\d ]+\]:.*\n?.*\n?)'
+    + r'|(?P<ignore>^(?:.*\.\. code:: .*\n(?!In\[[\d ]+\]:|.*# ignore this).*\n)?'
+    + r'.*# ignore this.*\n?.*\n?)'
+    + r'|(?P<image>^\.\. image:: (?P<imageFileName>.*))'
+    + r'|(?P<reference>\:(?P<referenceRole>class|ref|func|meth|attr)\:'
+    + r'\`\`?(?P<referenceTarget>.*?)\`\`?)',
+    re.MULTILINE)
+
+# a line of indented text directly followed by a line of unindented text
+# (the lookahead checks for text without backtracking, so long lines stay linear)
+_indentedThenUnindentedPattern = re.compile(r'^(?=[^\S\n]*\S)([^\S\n].*)\n(?=\S)',
+                                            re.MULTILINE)
+# a line with a parsed-literal directive
+_parsedLiteralPattern = re.compile(r'^(.*\.\. parsed-literal::.*)$', re.MULTILINE)
+
+# a link to a user's guide chapter in the user's guide table of contents
+_usersGuideLinkPattern = re.compile(r'\<(usersGuide.*)>')
+
 
 class DocumentationWritersException(exceptions21.Music21Exception):
     pass
@@ -113,30 +147,57 @@ class ReSTWriter(DocumentationWriter):
         '''
         Write ``rst`` (a unicode string) to ``filePath``, a pathlib.Path()
         only overwriting an existing file if the content differs.
+
+        The file is written and compared as utf-8 bytes, with '\n' line endings
+        on every platform.  The size of the existing file is checked first,
+        so that a file which has certainly changed is not read back in just to compare it.
         '''
+        try:
+            newBytes = rst.encode('utf-8')
+        except UnicodeEncodeError as uee:
+            raise DocumentationWritersException(
+                "Could not write %s with rst:\n%s" % (filePath, rst)) from uee
+
         shouldWrite = True
-        if filePath.exists():
-            oldRst = common.readFileEncodingSafe(filePath, firstGuess='utf-8')
-            if rst == oldRst:
+        try:
+            oldSize = filePath.stat().st_size
+        except FileNotFoundError:
+            oldSize = None
+
+        if oldSize is not None and oldSize == len(newBytes):
+            oldBytes = filePath.read_bytes()
+            if newBytes == oldBytes:
                 shouldWrite = False
             else:
                 pass
                 ## uncomment for  help in figuring out why a file keeps being different...
                 # import difflib
                 # print(common.relativepath(filePath))
+                # oldRst = oldBytes.decode('utf-8')
                 # print('\n'.join(difflib.ndiff(rst.split('\n'), oldRst.split('\n'))))
 
         if shouldWrite:
-            with filePath.open('w', encoding='utf-8') as f:
-                try:
-                    f.write(rst)
-                except UnicodeEncodeError as uee:
-                    raise DocumentationWritersException(
-                        "Could not write %s with rst:\n%s" % (filePath, rst)) from uee
+            self.writeAtomically(filePath, newBytes)
             print('\tWROTE   {0}'.format(common.relativepath(filePath)))
         else:
             print('\tSKIPPED {0}'.format(common.relativepath(filePath)))
 
+    def writeAtomically(self, filePath, data):
+        '''
+        Write ``data`` (bytes) to ``filePath``, a pathlib.Path(), by way of a
+        temporary file which then replaces ``filePath`` in one step,
+        so that a partially written file is never left behind.
+        '''
+        tempFilePath = filePath.with_name(filePath.name + '.tmp')
+        try:
+            with tempFilePath.open('wb') as f:
+                f.write(data)
+            os.replace(str(tempFilePath), str(filePath))
+        finally:
+            # still there only if something (even KeyboardInterrupt) went wrong
+            if tempFilePath.exists():
+                tempFilePath.unlink()
+
 class ModuleReferenceReSTWriter(ReSTWriter):
     '''
     Writes module reference ReST files, and their index.rst file.
@@ -149,7 +210,7 @@ class ModuleReferenceReSTWriter(ReSTWriter):
     def run(self):
         moduleReferenceDirectoryPath = self.outputDirectory
         referenceNames = []
-        for module in [x for x in iterators.ModuleIterator()]:
+        for module in iterators.ModuleIterator():
             moduleDocumenter = documenters.ModuleDocumenter(module)
             if (not moduleDocumenter.classDocumenters
                     and not moduleDocumenter.functionDocumenters):
@@ -157,7 +218,7 @@ class ModuleReferenceReSTWriter(ReSTWriter):
             rst = '\n'.join(moduleDocumenter.run())
             referenceName = moduleDocumenter.referenceName
             referenceNames.append(referenceName)
-            fileName = '{0}.rst'.format(referenceName)
+            fileName = f'{referenceName}.rst'
             rstFilePath = moduleReferenceDirectoryPath / fileName
 
             try:
@@ -171,21 +232,20 @@ class ModuleReferenceReSTWriter(ReSTWriter):
         '''
         Write the index.rst file from the list of reference names
         '''
-        lines = []
-        lines.append('.. moduleReference:')
-        lines.append('')
-        lines.append('.. WARNING: DO NOT EDIT THIS FILE:')
-        lines.append('   AUTOMATICALLY GENERATED.')
-        lines.append('')
-        lines.append('**Module Reference**')
-        lines.append('=========================')
-        lines.append('')
-        lines.append('.. toctree::')
-        lines.append('   :maxdepth: 1')
-        lines.append('')
-        for referenceName in sorted(referenceNames):
-            lines.append('   {0}'.format(referenceName))
-        rst = '\n'.join(lines)
+        toctreeEntries = '\n'.join(f'   {referenceName}'
+                                   for referenceName in sorted(referenceNames))
+        rst = f'''.. moduleReference:
+
+.. WARNING: DO NOT EDIT THIS FILE:
+   AUTOMATICALLY GENERATED.
+
+**Module Reference**
+=========================
+
+.. toctree::
+   :maxdepth: 1
+
+{toctreeEntries}'''
         indexFilePath = self.outputDirectory / 'index.rst'
         self.write(indexFilePath, rst)
 
@@ -214,28 +274,116 @@ class IPythonNotebookReSTWriter(ReSTWriter):
     Converts IPython notebooks into ReST, and handles their associated image
     files.
 
-    This class wraps the 3rd-party ``nbconvert`` Python script.
+    This class wraps the 3rd-party ``nbconvert`` library.
+
+    Notebooks are converted in parallel unless useMultiprocessing is False,
+    which can be helpful when debugging a notebook that will not convert.
     '''
-    def __init__(self):
-        from .iterators import IPythonNotebookIterator  # @UnresolvedImport
+    # nbconvert's RSTExporter is slow to set up, so one is made per process
+    # the first time that it is needed, and then shared.
+    _rstExporter = None
+
+    def __init__(self, useMultiprocessing=True):
         super(IPythonNotebookReSTWriter, self).__init__()
-        self.ipythonNotebookFilePaths = [x for x in IPythonNotebookIterator()]
+        self.ipythonNotebookFilePaths = list(iterators.IPythonNotebookIterator())
+        self.useMultiprocessing = useMultiprocessing
         # Do not run self.setupOutputDirectory()
 
     def run(self):
+        if self.useMultiprocessing:
+            runFunction = common.runParallel
+        else:
+            runFunction = common.runNonParallel
+
+        # a notebook whose contents have not changed since it was last converted
+        # does not need to be converted again, even if its mtime is newer.
+        oldNotebookHashes = self.readNotebookHashes()
+        newNotebookHashes = {}
+        currentNotebookHashes = {}
+        notebookFilePathsToConvert = []
         for ipythonNotebookFilePath in self.ipythonNotebookFilePaths:
-            nbConvertReturnCode = self.convertOneNotebook(ipythonNotebookFilePath)
-            if nbConvertReturnCode is True:
-                self.cleanupNotebookAssets(ipythonNotebookFilePath)
+            hashKey = self.notebookHashKey(ipythonNotebookFilePath)
+            notebookHash = self.notebookHash(ipythonNotebookFilePath)
+            if (oldNotebookHashes.get(hashKey) == notebookHash
+                    and self.notebookFilePathToRstFilePath(ipythonNotebookFilePath).exists()):
+                newNotebookHashes[hashKey] = notebookHash
+                continue
+            currentNotebookHashes[ipythonNotebookFilePath] = notebookHash
+            notebookFilePathsToConvert.append(ipythonNotebookFilePath)
+
+        # each notebook converts independently, so farm them out to other cores
+        # and report back here, so that the output is not interleaved.
+        wasConvertedList = runFunction(notebookFilePathsToConvert,
+                                       self.convertAndCleanupOneNotebook)
+        wasConvertedDict = dict(zip(notebookFilePathsToConvert, wasConvertedList))
+
+        # only record the new hash of a notebook that was actually converted:
+        # one skipped because its .rst is newer keeps its old entry (if any),
+        # so that it is still converted once its mtime moves past the .rst's.
+        for ipythonNotebookFilePath, notebookHash in currentNotebookHashes.items():
+            hashKey = self.notebookHashKey(ipythonNotebookFilePath)
+            if wasConvertedDict.get(ipythonNotebookFilePath, False) is True:
+                newNotebookHashes[hashKey] = notebookHash
+            elif hashKey in oldNotebookHashes:
+                newNotebookHashes[hashKey] = oldNotebookHashes[hashKey]
+
+        for ipythonNotebookFilePath in self.ipythonNotebookFilePaths:
+            if wasConvertedDict.get(ipythonNotebookFilePath, False) is True:
                 print('\tWROTE   {0}'.format(common.relativepath(
                     ipythonNotebookFilePath)))
             else:
                 print('\tSKIPPED {0}'.format(common.relativepath(
                     ipythonNotebookFilePath)))
 
-                # do not print anything for skipped -checkpoint files
+        self.writeNotebookHashes(newNotebookHashes)
         self.writeIndexRst()
 
+    @property
+    def notebookHashFilePath(self):
+        '''
+        The pathlib.Path of the JSON file recording the hash of each notebook
+        as of its last conversion.
+
+        >>> ipnw = IPythonNotebookReSTWriter()
+        >>> ipnw.notebookHashFilePath.name
+        '.notebookHashes.json'
+        '''
+        return self.docGeneratedPath / '.notebookHashes.json'
+
+    def notebookHashKey(self, ipythonNotebookFilePath):
+        '''
+        Returns the key for ipythonNotebookFilePath in the notebook hash file:
+        its path relative to the documentation source directory, as a string.
+        '''
+        return ipythonNotebookFilePath.relative_to(self.docSourcePath).as_posix()
+
+    def notebookHash(self, ipythonNotebookFilePath):
+        '''
+        Returns a hex digest of the contents of ipythonNotebookFilePath.
+        '''
+        return hashlib.blake2b(ipythonNotebookFilePath.read_bytes()).hexdigest()
+
+    def readNotebookHashes(self):
+        '''
+        Returns the dictionary of notebook hashes written at the end of the last run,
+        or an empty dictionary if there is none (or it cannot be read).
+        '''
+        try:
+            with self.notebookHashFilePath.open('r', encoding='utf-8') as f:
+                notebookHashes = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(notebookHashes, dict):
+            return {}
+        return notebookHashes
+
+    def writeNotebookHashes(self, notebookHashes):
+        '''
+        Writes the dictionary of notebook hashes.
+        '''
+        hashText = json.dumps(notebookHashes, indent=1, sort_keys=True)
+        self.writeAtomically(self.notebookHashFilePath, hashText.encode('utf-8'))
+
     def writeIndexRst(self):
         '''
         Writes out the index.rst file for the usersGuide directory.
@@ -261,44 +409,70 @@ class IPythonNotebookReSTWriter(ReSTWriter):
 
         with tocFp.open('r', encoding='utf-8') as tocf:
             for line in tocf:
-                matched = re.search(r'\<(usersGuide.*)>', line)
+                matched = _usersGuideLinkPattern.search(line)
                 if matched:
                     usersGuideInOrder.append(matched.group(1))
 
 
-        lines = []
-        lines.append('.. usersGuide:')
-        lines.append('')
-        lines.append('.. WARNING: DO NOT EDIT THIS FILE:')
-        lines.append('   AUTOMATICALLY GENERATED.')
-        lines.append('')
-        lines.append("User's Guide")
-        lines.append('================')
-        lines.append('')
-        lines.append('.. toctree::')
-        lines.append('   :maxdepth: 1')
-        lines.append('')
-        for referenceName in usersGuideInOrder:
-            lines.append('   {0}'.format(referenceName))
+        toctreeEntries = '\n'.join(f'   {referenceName}'
+                                   for referenceName in usersGuideInOrder)
+        rst = f'''.. usersGuide:
 
-        rst = '\n'.join(lines)
+.. WARNING: DO NOT EDIT THIS FILE:
+   AUTOMATICALLY GENERATED.
+
+User's Guide
+================
+
+.. toctree::
+   :maxdepth: 1
+
+{toctreeEntries}'''
         indexFilePath = usersGuideDir / 'index.rst'
         self.write(indexFilePath, rst)
 
 
-    def cleanupNotebookAssets(self, ipythonNotebookFilePath):
+    def cleanupNotebookAssets(self, ipythonNotebookFilePath, *, outputBasePath=None):
         '''
-        Deletes all .text files in the directory of ipythonNotebookFilePath
-        (a pathlib.Path).
+        Deletes the .text outputs extracted from ipythonNotebookFilePath
+        (a pathlib.Path).  nbconvert writes each extracted output next to the
+        .rst file, named stem_cell_index.ext (for instance usersGuide_02_notes_77_0.png),
+        so only files named like that for this notebook are removed.
+
+        outputBasePath, from .notebookOutputBasePath(), can be given if it is already known.
+
+        A notebook without any such directory is not a problem:
+
+        >>> ipnw = IPythonNotebookReSTWriter()
+        >>> ipnw.cleanupNotebookAssets(ipnw.docSourcePath / 'notAFolder' / 'noNotebook.ipynb')
         '''
-        notebookFileNameWithoutExtension = ipythonNotebookFilePath.stem
-        notebookParentDirectoryPath = ipythonNotebookFilePath.parent
-        imageFileDirectoryPath = notebookParentDirectoryPath / notebookFileNameWithoutExtension
-        imageFileDirectoryPath = self.sourceToAutogenerated(imageFileDirectoryPath)
-        if not imageFileDirectoryPath.exists():
+        if outputBasePath is None:
+            outputBasePath = self.notebookOutputBasePath(ipythonNotebookFilePath)
+        textOutputPattern = re.compile(re.escape(outputBasePath.name) + r'_\d+_\d+\.text$')
+        # scandir gives back names and full paths without another stat() per file
+        try:
+            with os.scandir(str(outputBasePath.parent)) as directoryEntries:
+                for entry in directoryEntries:
+                    if textOutputPattern.match(entry.name):
+                        os.unlink(entry.path)
+        except FileNotFoundError:
             return
-        for filePath in sorted(imageFileDirectoryPath.glob('*.text')):
-            filePath.unlink()
+
+    def convertAndCleanupOneNotebook(self, ipythonNotebookFilePath):
+        '''
+        Converts one notebook and, if it was converted, cleans up its assets.
+
+        Returns True if the notebook was converted, False if it was skipped.
+
+        This is the function run on each core by .run(), so it does not print anything.
+        '''
+        # work out where the output goes once, for both steps.
+        outputBasePath = self.notebookOutputBasePath(ipythonNotebookFilePath)
+        wasConverted = self.convertOneNotebook(ipythonNotebookFilePath,
+                                               outputBasePath=outputBasePath)
+        if wasConverted is True:
+            self.cleanupNotebookAssets(ipythonNotebookFilePath, outputBasePath=outputBasePath)
+        return wasConverted
 
     @property
     def rstEditingWarningFormat(self):
@@ -310,140 +484,355 @@ class IPythonNotebookReSTWriter(ReSTWriter):
         return result
 
 
+    def notebookOutputBasePath(self, ipythonNotebookFilePath):
+        '''
+        Returns the pathlib.Path in the autogenerated directory that everything
+        converted from ipythonNotebookFilePath is named after: the .rst file
+        without its extension.  It is not a directory; nbconvert puts the
+        extracted outputs beside the .rst file, as this path's name plus
+        _cell_index.ext.
+
+        >>> ipnw = IPythonNotebookReSTWriter()
+        >>> nbPath = ipnw.docSourcePath / 'about' / 'what.ipynb'
+        >>> ipnw.notebookOutputBasePath(nbPath) == ipnw.docGeneratedPath / 'about' / 'what'
+        True
+        '''
+        return (self.sourceToAutogenerated(ipythonNotebookFilePath.parent)
+                / ipythonNotebookFilePath.stem)
+
     def notebookFilePathToRstFilePath(self, ipythonNotebookFilePath):
+        '''
+        Returns the pathlib.Path of the .rst file in the autogenerated directory
+        for ipythonNotebookFilePath.
+
+        Raises a DocumentationWritersException if the notebook does not exist.
+        '''
         if not ipythonNotebookFilePath.exists():
             raise DocumentationWritersException(
                 'No iPythonNotebook with filePath %s' % ipythonNotebookFilePath)
-        notebookFileNameWithoutExtension = ipythonNotebookFilePath.stem
-        notebookParentDirectoryPath = ipythonNotebookFilePath.parent
-        rstFileName = notebookFileNameWithoutExtension + '.rst'
-        rstFilePath = self.sourceToAutogenerated(notebookParentDirectoryPath / rstFileName)
-        return rstFilePath
+        outputBasePath = self.notebookOutputBasePath(ipythonNotebookFilePath)
+        return outputBasePath.with_name(outputBasePath.name + '.rst')
 
-    def convertOneNotebook(self, ipythonNotebookFilePath):
+    def convertOneNotebook(self, ipythonNotebookFilePath, *, outputBasePath=None):
         '''
         converts one .ipynb file to .rst using nbconvert.
 
         returns True if IPythonNotebook was converted.
         returns False if IPythonNotebook's converted .rst file is newer than the .ipynb file.
 
-        sends AssertionError if ipythonNotebookFilePath does not exist.
-        '''
-        rstFilePath = self.notebookFilePathToRstFilePath(ipythonNotebookFilePath)
-        if rstFilePath.exists():
-            # print(rstFilePath + ' exists')
-            # rst file is newer than .ipynb file, do not convert.
+        outputBasePath, from .notebookOutputBasePath(), can be given if it is already known.
 
-            if rstFilePath.stat().st_mtime > ipythonNotebookFilePath.stat().st_mtime:
-                return False
+        raises DocumentationWritersException if ipythonNotebookFilePath does not exist.
+        '''
+        if outputBasePath is None:
+            outputBasePath = self.notebookOutputBasePath(ipythonNotebookFilePath)
+        rstFilePath = outputBasePath.with_name(outputBasePath.name + '.rst')
+        # one stat() each for the notebook and the .rst file
+        try:
+            notebookStat = ipythonNotebookFilePath.stat()
+        except FileNotFoundError as fnfe:
+            raise DocumentationWritersException(
+                'No iPythonNotebook with filePath %s' % ipythonNotebookFilePath) from fnfe
+        try:
+            rstStat = rstFilePath.stat()
+        except FileNotFoundError:
+            rstStat = None
 
-        self.runNBConvert(ipythonNotebookFilePath)
-        # 'encoding' is an invalid keyword argument for the built-in 'open' in python 2.
-        with rstFilePath.open('r', encoding='utf8') as f:
-            oldLines = f.read().splitlines()
+        # rst file is newer than .ipynb file, do not convert.
+        if rstStat is not None and rstStat.st_mtime > notebookStat.st_mtime:
+            return False
 
-        lines = self.cleanConvertedNotebook(oldLines, ipythonNotebookFilePath)
-        with rstFilePath.open('w', encoding='utf8') as f:
-            f.write('\n'.join(lines))
+        # the converted ReST is cleaned up before it is ever written out,
+        # rather than being written, read back in, and written again.
+        oldText = self.runNBConvert(ipythonNotebookFilePath, outputBasePath=outputBasePath)
+        rst = self.cleanConvertedNotebook(oldText, ipythonNotebookFilePath)
+        self.writeAtomically(rstFilePath, rst.encode('utf-8'))
 
         return True
 
 
-    def cleanConvertedNotebook(self, oldLines, ipythonNotebookFilePath):
+    def cleanConvertedNotebook(self, oldText, ipythonNotebookFilePath):
         '''
-        Take a notebook directly as parsed and make it look better for HTML
+        Take a notebook directly as parsed (a string) and make it look better for HTML.
+        Returns the new ReST as a string.
 
-        Fixes up the internal references to class, ref, func, meth, attr.
+        Removes IPython prompts and code blocks marked "# ignore this", shortens
+        image paths, and fixes up the internal references to class, ref, func, meth, attr.
+
+        >>> ipnw = IPythonNotebookReSTWriter()
+        >>> nbPath = ipnw.ipythonNotebookFilePaths[0]
+        >>> nbPath.stem
+        'what'
+        >>> oldText = '\\n'.join([
+        ...     '.. code:: python',
+        ...     '',
+        ...     '    # ignore this',
+        ...     '    %load_ext music21.ipython21',
+        ...     'In[1]:',
+        ...     '',
+        ...     'See :class:``~music21.note.Note``.',
+        ...     '.. image:: what_files/what_3_0.png',
+        ...     ])
+        >>> print(ipnw.cleanConvertedNotebook(oldText, nbPath))
+        .. _what:
+        <BLANKLINE>
+        .. WARNING: DO NOT EDIT THIS FILE:
+           AUTOMATICALLY GENERATED.
+           PLEASE EDIT THE .py FILE DIRECTLY.
+        <BLANKLINE>
+        See :class:`~music21.note.Note`.
+        .. image:: what_3_0.png
+
+        The '.. code:: ' line goes with an ignored block only when it is exactly
+        two lines above "# ignore this" in the converted text:
+
+        >>> oldText = '\\n'.join([
+        ...     'Before.',
+        ...     '.. code:: python',
+        ...     '',
+        ...     '    # ignore this',
+        ...     '    %load_ext music21.ipython21',
+        ...     'After.',
+        ...     ])
+        >>> ipnw.cleanConvertedNotebook(oldText, nbPath).splitlines()[6:]
+        ['Before.', 'After.']
+
+        A prompt in between is removed on its own (taking the line after it,
+        as prompts always do), and the directive stays:
+
+        >>> oldText = '\\n'.join([
+        ...     '.. code:: python',
+        ...     'In[1]:',
+        ...     '    # ignore this',
+        ...     '    %load_ext music21.ipython21',
+        ...     ])
+        >>> ipnw.cleanConvertedNotebook(oldText, nbPath).splitlines()[6:]
+        ['.. code:: python', '    %load_ext music21.ipython21']
+
+        As does another "# ignore this" line in between:
+
+        >>> oldText = '\\n'.join([
+        ...     '.. code:: python',
+        ...     '    # ignore this',
+        ...     '    # ignore this',
+        ...     'After.',
+        ...     ])
+        >>> ipnw.cleanConvertedNotebook(oldText, nbPath).splitlines()[6:]
+        ['.. code:: python', 'After.']
         '''
         notebookFileNameWithoutExtension = ipythonNotebookFilePath.stem
-        # imageFileDirectoryName = self.sourceToAutogenerated(notebookFileNameWithoutExtension)
-
-        ipythonPromptPattern = re.compile(r'^In\[[\d ]+\]:')
-        mangledInternalReference = re.compile(
-            r'\:(class|ref|func|meth|attr)\:\`\`?(.*?)\`\`?')
-        newLines = ['.. _' + notebookFileNameWithoutExtension + ":" ,
-                    ''] + self.rstEditingWarningFormat
-        currentLineNumber = 0
-
-        while currentLineNumber < len(oldLines):
-            currentLine = oldLines[currentLineNumber]
-            # Remove all IPython prompts and the blank line that follows:
-            if ipythonPromptPattern.match(currentLine) is not None:
-                currentLineNumber += 2
-                continue
-            # Correct the image path in each ReST image directive:
-            elif currentLine.startswith('.. image:: '):
-                imageFileName = currentLine.partition('.. image:: ')[2]
-                imageFileShort = imageFileName.split(os.path.sep)[-1]
-                if notebookFileNameWithoutExtension in currentLine:
-                    newImageDirective = '.. image:: {0}'.format(
-                        imageFileShort,
-                        )
-                    newLines.append(newImageDirective)
-                else:
-                    newLines.append(currentLine)
-                currentLineNumber += 1
-            elif "# ignore this" in currentLine:
-                if '.. code:: ' in newLines[-2]:
-                    # print("STOP HERE!")
-                    newLines.pop()  # remove blank line
-                    newLines.pop()  # remove '.. code:: python'
-
-                currentLineNumber += 2  #  # ignore this
-                                        #  %load_ext music21.ipython21.ipExtension
-                # TODO: Skip all % lines, without looking for "#ignore this"
-            # Otherwise, nothing special to do, just add the line to our results:
-            else:
+
+        def cleanMatch(match):
+            matchType = match.lastgroup
+            if matchType == 'image':
+                # Correct the image path in each ReST image directive:
+                if notebookFileNameWithoutExtension not in match.group(0):
+                    return match.group(0)
+                imageFileShort = match.group('imageFileName').split(os.path.sep)[-1]
+                return '.. image:: ' + imageFileShort
+            elif matchType == 'reference':
                 # fix cases of inline :class:`~music21.stream.Stream` being
                 # converted by markdown to :class:``~music21.stream.Stream``
-                newCurrentLine = mangledInternalReference.sub(
-                    r':\1:`\2`',
-                    currentLine
-                    )
-                newLines.append(newCurrentLine)
-                currentLineNumber += 1
-
-        lines = self.blankLineAfterLiteral(newLines)
-
-        return lines
-
-    def blankLineAfterLiteral(self, oldLines):
-        '''
-        Guarantee a blank line after literal blocks.
-        '''
-        lines = [oldLines[0]]  # start with first line...
-        for first, second in windowed(oldLines, 2):
-            if (first.strip()
-                    and first[0].isspace()
-                    and second.strip()
-                    and not second[0].isspace()):
-                lines.append('')
-            lines.append(second)
-            if '.. parsed-literal::' in second:
-                lines.append('   :class: ipython-result')
-        return lines
-
-    def runNBConvert(self, ipythonNotebookFilePath):
+                return ':{0}:`{1}`'.format(match.group('referenceRole'),
+                                           match.group('referenceTarget'))
+            else:
+                # IPython prompts and "# ignore this" blocks (with the lines
+                # that go with them) are removed entirely.
+                return ''
+
+        newText = _notebookCleanupPattern.sub(cleanMatch, oldText)
+        newText = self.blankLineAfterLiteral(newText)
+
+        # the header ends with a blank line, so blankLineAfterLiteral has nothing to do there.
+        header = '\n'.join(['.. _' + notebookFileNameWithoutExtension + ":", '']
+                           + self.rstEditingWarningFormat)
+        if not newText:
+            return header
+        # a final newline is dropped, as splitting into lines and joining them again would do.
+        if newText.endswith('\n'):
+            newText = newText[:-1]
+        return header + '\n' + newText
+
+    def blankLineAfterLiteral(self, oldText):
+        '''
+        Guarantee a blank line after literal blocks, and give each
+        parsed-literal block the ipython-result class.  Takes and returns a string.
+
+        >>> ipnw = IPythonNotebookReSTWriter()
+        >>> print(ipnw.blankLineAfterLiteral('.. parsed-literal::\\n\\n    out\\ntext'))
+        .. parsed-literal::
+           :class: ipython-result
+        <BLANKLINE>
+            out
+        <BLANKLINE>
+        text
+        '''
+        # the blank lines go in first, so that the :class: line added after a
+        # parsed-literal line does not count as indented text.
+        newText = _indentedThenUnindentedPattern.sub(r'\1\n\n', oldText)
+        return _parsedLiteralPattern.sub(r'\1\n   :class: ipython-result', newText)
+
+    def runNBConvert(self, ipythonNotebookFilePath, *, outputBasePath=None):
+        '''
+        Runs nbconvert on ipythonNotebookFilePath, writes the images and other
+        files that it extracts into the autogenerated directory, and returns the
+        converted ReST as a string, for .convertOneNotebook() to clean up and write.
+
+        The notebooks are not executed; the outputs already
+        saved in the .ipynb file are used, so no Jupyter kernel is started here.
+
+        Calls the nbconvert library directly rather than going through
+        its command-line NbConvertApp.
+
+        outputBasePath, from .notebookOutputBasePath(), can be given if it is already known.
+        '''
         try:
-            from nbconvert import nbconvertapp as nb
+            from nbconvert import RSTExporter
         except ImportError:
             environLocal.warn("nbconvert is not installed, run pip3 install nbconvert")
             raise
 
-        outputPath = os.path.splitext(str(self.sourceToAutogenerated(
-                                                    ipythonNotebookFilePath)))[0]
-
-        app = nb.NbConvertApp.instance()  # @UndefinedVariable
-        app.initialize(argv=['--to', 'rst', '--output', outputPath,
-                             str(ipythonNotebookFilePath)])
-        app.writer.build_directory = str(ipythonNotebookFilePath.parent)
-        app.start()
+        if IPythonNotebookReSTWriter._rstExporter is None:
+            IPythonNotebookReSTWriter._rstExporter = RSTExporter()
+
+        if outputBasePath is None:
+            outputBasePath = self.notebookOutputBasePath(ipythonNotebookFilePath)
+        outputPath = str(outputBasePath)
+
+        # the same resources that NbConvertApp sets up for ``--output outputPath``
+        resources = {'unique_key': outputPath,
+                     'output_files_dir': outputPath + '_files',
+                     }
+        body, resources = IPythonNotebookReSTWriter._rstExporter.from_filename(
+            str(ipythonNotebookFilePath), resources=resources)
+
+        # what nbconvert's FilesWriter does for these, without also writing the body.
+        # The file names are absolute, since outputPath is.
+        buildDirectory = ipythonNotebookFilePath.parent
+        for extractedFiles in (resources.get('outputs', {}), resources.get('attachments', {})):
+            for fileName, data in extractedFiles.items():
+                extractedFilePath = buildDirectory / fileName
+                extractedFilePath.parent.mkdir(parents=True, exist_ok=True)
+                extractedFilePath.write_bytes(data)
+        return body
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDirectory = tempfile.TemporaryDirectory()
+        tempPath = pathlib.Path(self.tempDirectory.name).resolve()
+        self.ipnw = IPythonNotebookReSTWriter(useMultiprocessing=False)
+        self.ipnw.docSourcePath = tempPath / 'source'
+        self.ipnw.docGeneratedPath = tempPath / 'autogenerated'
+        self.ipnw.docSourcePath.mkdir()
+        self.ipnw.docGeneratedPath.mkdir()
+        self.notebookFilePaths = []
+        for name in ('one', 'two'):
+            notebookFilePath = self.ipnw.docSourcePath / (name + '.ipynb')
+            notebookFilePath.write_text('{"cells": ["' + name + '"]}')
+            self.notebookFilePaths.append(notebookFilePath)
+        self.ipnw.ipythonNotebookFilePaths = self.notebookFilePaths
+        self.ipnw.writeIndexRst = lambda: None
+        self.converted = []
+        self.ipnw.convertAndCleanupOneNotebook = self._fakeConvert
+
+    def tearDown(self):
+        self.tempDirectory.cleanup()
+
+    def _fakeConvert(self, ipythonNotebookFilePath):
+        self.converted.append(ipythonNotebookFilePath.stem)
+        self.ipnw.notebookFilePathToRstFilePath(ipythonNotebookFilePath).write_text('rst')
         return True
 
+    def _run(self):
+        self.converted = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.ipnw.run()
+        return self.converted
+
+    def testUnchangedNotebooksSkipped(self):
+        self.assertEqual(self._run(), ['one', 'two'])
+        self.assertEqual(self._run(), [])
+
+    def testChangedNotebookConverted(self):
+        self._run()
+        self.notebookFilePaths[1].write_text('{"cells": ["changed"]}')
+        self.assertEqual(self._run(), ['two'])
+        self.assertEqual(self._run(), [])
+
+    def testMissingRstConverted(self):
+        self._run()
+        self.ipnw.notebookFilePathToRstFilePath(self.notebookFilePaths[0]).unlink()
+        self.assertEqual(self._run(), ['one'])
+
+    def testWriteAtomicallyInterrupted(self):
+        filePath = self.ipnw.docGeneratedPath / 'one.rst'
+        filePath.write_bytes(b'old')
+
+        from unittest import mock  # pylint: disable=no-name-in-module
+        with mock.patch('os.replace', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.ipnw.writeAtomically(filePath, b'new')
+        self.assertEqual(filePath.read_bytes(), b'old')
+        self.assertEqual(sorted(p.name for p in filePath.parent.iterdir()), ['one.rst'])
+
+        self.ipnw.writeAtomically(filePath, b'new')
+        self.assertEqual(filePath.read_bytes(), b'new')
+        self.assertEqual(sorted(p.name for p in filePath.parent.iterdir()), ['one.rst'])
+
+    def testCleanupNotebookAssets(self):
+        outputDirectoryPath = self.ipnw.docGeneratedPath
+        fileNames = ['one_3_0.text', 'one_3_0.png', 'one_extra_3_0.text',
+                     'two_1_0.text', 'one.rst']
+        for fileName in fileNames:
+            (outputDirectoryPath / fileName).write_text('x')
+        self.ipnw.cleanupNotebookAssets(self.notebookFilePaths[0])
+        self.assertEqual(sorted(p.name for p in outputDirectoryPath.iterdir()),
+                         sorted(fileNames[1:]))
+
+    def testSkippedNotebookKeepsOldHash(self):
+        # the real conversion, with nbconvert itself left out
+        del self.ipnw.convertAndCleanupOneNotebook
+        self.ipnw.runNBConvert = lambda p, outputBasePath=None: p.read_text()
+        notebookFilePath = self.notebookFilePaths[0]
+        rstFilePath = self.ipnw.notebookFilePathToRstFilePath(notebookFilePath)
+        self._run()
+        self.assertIn('"one"', rstFilePath.read_text())
+
+        # new contents, but an mtime older than the .rst (as from cp -p or tar x)
+        notebookFilePath.write_text('{"cells": ["newer"]}')
+        rstMTime = rstFilePath.stat().st_mtime
+        os.utime(str(notebookFilePath), (rstMTime - 100, rstMTime - 100))
+        self._run()
+        self.assertIn('"one"', rstFilePath.read_text())
+
+        # touching the notebook must still bring it up to date
+        os.utime(str(notebookFilePath), (rstMTime + 100, rstMTime + 100))
+        self._run()
+        self.assertIn('"newer"', rstFilePath.read_text())
+
+    def testBlankLineAfterLiteralLongLine(self):
+        # a pattern that backtracks over the line took seconds on this
+        longLine = ' ' + 'x' * 50000
+        oldText = longLine + '\n  still indented\n'
+        startTime = time.perf_counter()
+        self.assertEqual(self.ipnw.blankLineAfterLiteral(oldText), oldText)
+        self.assertEqual(self.ipnw.blankLineAfterLiteral(longLine + '\nunindented'),
+                         longLine + '\n\nunindented')
+        self.assertLess(time.perf_counter() - startTime, 1.0)
+
+    def testBadHashFile(self):
+        hashFilePath = self.ipnw.notebookHashFilePath
+        for badContents in ('{not json', '["a list"]', '3'):
+            hashFilePath.write_text(badContents)
+            self.assertEqual(self.ipnw.readNotebookHashes(), {})
+            self.assertEqual(self._run(), ['one', 'two'])
+
+
 if __name__ == '__main__':
     i = IPythonNotebookReSTWriter()
     p5 = i.ipythonNotebookFilePaths[5]
     i.convertOneNotebook(p5)
     import music21
-    music21.mainTest('moduleRelative')
+    music21.mainTest(Test, 'moduleRelative')
 